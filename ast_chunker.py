@@ -0,0 +1,83 @@
+import ast,re
+from bisect import bisect_left
+
+def _line_starts(code:str):
+    return [0]+[match.end() for match in re.finditer(r"\r\n|\r|\n",code)]
+
+def _start_line(node):
+    return min([node.lineno]+[decorator.lineno for decorator in getattr(node,"decorator_list",[])])
+
+def unit_boundaries(code:str):
+    # Character offsets at which each top-level statement starts, decorators
+    # included. Files that do not parse are treated as a single unit.
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError,ValueError):
+        return [0]
+    line_starts = _line_starts(code)
+    return [0]+[line_starts[_start_line(node)-1] for node in tree.body[1:]]
+
+def definition_spans(code:str):
+    # (kind, qualified name, first line, last line, start offset, end offset)
+    # of every class and function, nested ones included. Decorators belong to
+    # their definition and offsets cover whole lines.
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError,ValueError):
+        return []
+    line_starts = _line_starts(code)+[len(code)]
+    spans = []
+    def visit(node,prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child,(ast.ClassDef,ast.FunctionDef,ast.AsyncFunctionDef)):
+                name = prefix+child.name
+                start_line, end_line = _start_line(child), child.end_lineno
+                spans.append(("class" if isinstance(child,ast.ClassDef) else "function",name,start_line,end_line,
+                              line_starts[start_line-1],line_starts[min(end_line,len(line_starts)-1)]))
+                visit(child,name+".")
+            else:
+                visit(child,prefix)
+    visit(tree,"")
+    return sorted(spans,key=lambda span: (span[2],-span[3]))
+
+def definition_offsets(code:str):
+    # Character offsets of every class and function definition, nested ones
+    # included. Used to rank windows when a file has to be sampled.
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError,ValueError):
+        return []
+    line_starts = _line_starts(code)
+    return sorted(line_starts[_start_line(node)-1] for node in ast.walk(tree)
+                  if isinstance(node,(ast.ClassDef,ast.FunctionDef,ast.AsyncFunctionDef)))
+
+def pack_windows(token_offsets:list,boundaries:list,max_tokens:int,overlap:int):
+    # Greedily packs consecutive top-level units into windows of at most
+    # max_tokens tokens. Only a unit that is larger than a window on its own is
+    # split, with `overlap` tokens shared between its consecutive windows.
+    # Returns (start, end) token ranges.
+    if max_tokens <= overlap:
+        raise ValueError(f"max_tokens must exceed overlap={overlap}, got {max_tokens}")
+    unit_starts = [bisect_left(token_offsets,boundary) for boundary in boundaries]+[len(token_offsets)]
+    windows = []
+    current = None
+    for start, end in zip(unit_starts,unit_starts[1:]):
+        if end <= start:
+            continue
+        if end-start > max_tokens:
+            if current:
+                windows.append(current)
+                current = None
+            for window_start in range(start,end,max_tokens-overlap):
+                windows.append((window_start,min(window_start+max_tokens,end)))
+                if window_start+max_tokens >= end:
+                    break
+        elif current and end-current[0] <= max_tokens:
+            current = (current[0],end)
+        else:
+            if current:
+                windows.append(current)
+            current = (start,end)
+    if current:
+        windows.append(current)
+    return windows or [(0,0)]
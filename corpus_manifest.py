@@ -0,0 +1,90 @@
+import hashlib,json,os,sqlite3
+from utils import get_folders, walk_files
+
+class CorpusManifest:
+    # Persistent record of every corpus file: label (pattern folder), size,
+    # mtime, content hash and the embedding cache keys computed for it. scan()
+    # diffs a pattern tree against it so a run only embeds what changed.
+    # config fingerprints the generator settings (embedding_generator.config_fingerprint);
+    # files recorded under another fingerprint are reported as changed.
+    def __init__(self,path:str,config:str=""):
+        os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, label TEXT, size INTEGER, "
+                                "mtime_ns INTEGER, sha256 TEXT, embedding_keys TEXT, config TEXT)")
+        if "config" not in [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]:
+            self.connection.execute("ALTER TABLE files ADD COLUMN config TEXT")
+        self.config = config
+        self._pending = {}
+
+    @staticmethod
+    def file_hash(path:str):
+        digest = hashlib.sha256()
+        with open(path,"rb") as file:
+            for block in iter(lambda: file.read(1<<20),b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def scan(self,repo_path:str,exclude:tuple=("embeddings",)):
+        # Files whose size and mtime match the manifest are unchanged without
+        # being read; the others are hashed, so a touched but identical file
+        # only has its metadata refreshed. Returns {added, changed, unchanged,
+        # deleted}: lists of (path, label), deleted only holds paths.
+        known = {path: (label,size,mtime_ns,sha256,config) for path, label, size, mtime_ns, sha256, config
+                 in self.connection.execute("SELECT path, label, size, mtime_ns, sha256, config FROM files")}
+        diff = {"added": [], "changed": [], "unchanged": [], "deleted": []}
+        refreshed = []
+        seen = set()
+        for label in get_folders(repo_path):
+            if label in exclude:
+                continue
+            for path in walk_files(os.path.join(repo_path,label)):
+                seen.add(path)
+                stat = os.stat(path)
+                entry = known.get(path)
+                if entry is not None and entry[0] == label and entry[1] == stat.st_size and entry[2] == stat.st_mtime_ns \
+                        and entry[4] == self.config:
+                    diff["unchanged"].append((path,label))
+                    continue
+                sha256 = self.file_hash(path)
+                if entry is None:
+                    diff["added"].append((path,label))
+                elif entry[0] == label and entry[3] == sha256 and entry[4] == self.config:
+                    refreshed.append((stat.st_size,stat.st_mtime_ns,path))
+                    diff["unchanged"].append((path,label))
+                    continue
+                else:
+                    diff["changed"].append((path,label))
+                self._pending[path] = (label,stat.st_size,stat.st_mtime_ns,sha256)
+        diff["deleted"] = [path for path in known if path not in seen]
+        if refreshed:
+            self.connection.executemany("UPDATE files SET size = ?, mtime_ns = ? WHERE path = ?",refreshed)
+            self.connection.commit()
+        return diff
+
+    def record(self,items:dict):
+        # items: {path: {pooling: embedding cache key}}. Files returned as added
+        # or changed by the last scan are inserted with their new metadata;
+        # other files only have their keys replaced.
+        rows, updates = [], []
+        for path, keys in items.items():
+            if path in self._pending:
+                rows.append((path,*self._pending.pop(path),json.dumps(keys),self.config))
+            else:
+                updates.append((json.dumps(keys),self.config,path))
+        self.connection.executemany("INSERT OR REPLACE INTO files (path, label, size, mtime_ns, sha256, embedding_keys, config) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?)",rows)
+        self.connection.executemany("UPDATE files SET embedding_keys = ?, config = ? WHERE path = ?",updates)
+        self.connection.commit()
+
+    def remove(self,paths:list):
+        self.connection.executemany("DELETE FROM files WHERE path = ?",[(path,) for path in paths])
+        self.connection.commit()
+
+    def entries(self):
+        # (path, label, {pooling: key}) of every recorded file, grouped by label.
+        for path, label, keys in self.connection.execute("SELECT path, label, embedding_keys FROM files ORDER BY label, path"):
+            yield path, label, json.loads(keys)
+
+    def close(self):
+        self.connection.close()
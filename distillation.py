@@ -0,0 +1,134 @@
+import copy,os
+import torch
+from transformers import AutoConfig, AutoModel, AutoTokenizer, T5EncoderModel
+from transformers.modeling_outputs import BaseModelOutput
+from embedding_generator import EmbeddingGenerator, masked_mean, schedule_batches
+from utils import get_all_python_files, load_code_from_file
+
+PROJECTION_FILE = "projection.pt"
+
+class StudentEncoder(torch.nn.Module):
+    # A small encoder of the teacher's architecture followed by a linear
+    # projection to the teacher's hidden size. Mean pooling commutes with the
+    # projection, so pooled student vectors live in the teacher's space and the
+    # model drops into EmbeddingGenerator like any other encoder.
+    def __init__(self,encoder:torch.nn.Module,output_size:int):
+        super().__init__()
+        self.encoder = encoder
+        self.projection = torch.nn.Linear(encoder.config.hidden_size,output_size)
+        self.config = copy.deepcopy(encoder.config)
+        self.config.hidden_size = output_size
+
+    def forward(self,input_ids,attention_mask,output_hidden_states:bool=False,**kwargs):
+        outputs = self.encoder(input_ids=input_ids,attention_mask=attention_mask,output_hidden_states=output_hidden_states)
+        hidden_states = None
+        if output_hidden_states:
+            hidden_states = tuple(self.projection(hidden) for hidden in outputs.hidden_states)
+        return BaseModelOutput(last_hidden_state=self.projection(outputs.last_hidden_state),hidden_states=hidden_states)
+
+    def save_pretrained(self,path:str):
+        self.encoder.config.projection_size = self.projection.out_features
+        self.encoder.save_pretrained(path)
+        torch.save(self.projection.state_dict(),os.path.join(path,PROJECTION_FILE))
+
+    @classmethod
+    def from_pretrained(cls,path:str,**kwargs):
+        config = AutoConfig.from_pretrained(path)
+        encoder = (T5EncoderModel if config.model_type in ("t5","mt5") else AutoModel).from_pretrained(path,**kwargs)
+        student = cls(encoder,encoder.config.projection_size)
+        student.projection.load_state_dict(torch.load(os.path.join(path,PROJECTION_FILE)))
+        return student
+
+def build_student(teacher_name:str,num_layers:int=4,hidden_size:int=256,num_attention_heads:int=4):
+    # Same architecture and vocabulary as the teacher, so the teacher's tokenizer
+    # and chunking apply unchanged; only depth and width shrink.
+    config = AutoConfig.from_pretrained(teacher_name)
+    teacher_hidden_size = config.hidden_size
+    config.num_hidden_layers = num_layers
+    config.hidden_size = hidden_size
+    config.num_attention_heads = num_attention_heads
+    for name in ("intermediate_size","d_ff","n_inner"):
+        if getattr(config,name,None) is not None:
+            setattr(config,name,4*hidden_size)
+    if hasattr(config,"d_kv"):
+        config.d_kv = hidden_size//num_attention_heads
+    if config.model_type in ("t5","mt5"):
+        encoder = T5EncoderModel(config)
+    else:
+        encoder = AutoModel.from_config(config)
+    return StudentEncoder(encoder,teacher_hidden_size)
+
+def teacher_targets(teacher:EmbeddingGenerator,codes:list,files_per_batch:int=64):
+    # Unique token windows of the corpus and the teacher's pooled vector for
+    # each; identical windows (licence headers, imports...) are kept once.
+    windows = {}
+    for start in range(0,len(codes),files_per_batch):
+        input_ids, attention_mask, _, _ = teacher._tokenize(codes[start:start+files_per_batch])
+        lengths = attention_mask.sum(1).tolist()
+        for ids, length in zip(input_ids,lengths):
+            windows.setdefault(ids[:length].numpy().tobytes(),ids[:length])
+    rows = list(windows.values())
+    input_ids = torch.nn.utils.rnn.pad_sequence(rows,batch_first=True,padding_value=teacher.tokenizer.pad_token_id)
+    attention_mask = torch.nn.utils.rnn.pad_sequence([torch.ones_like(row) for row in rows],batch_first=True)
+    targets = torch.empty(len(rows),teacher.model.config.hidden_size)
+    for batch in schedule_batches([len(row) for row in rows],teacher.batch_size):
+        targets[batch] = teacher._embed_chunks(input_ids[batch],attention_mask[batch])["last_hidden_state_mean"].cpu()
+    return input_ids, attention_mask, targets
+
+def distill(teacher_name:str,train_paths:list,output_dir:str,num_layers:int=4,hidden_size:int=256,num_attention_heads:int=4,
+            epochs:int=3,batch_size:int=32,learning_rate:float=5e-4,seed:int=42):
+    # Trains the student on CPU to reproduce the teacher's mean-pooled window
+    # vectors over every .py file under train_paths. File embeddings are means
+    # of window vectors, so matching windows also matches files.
+    torch.manual_seed(seed)
+    teacher = EmbeddingGenerator(teacher_name)
+    codes = [load_code_from_file(file) for path in train_paths for file in get_all_python_files(path)]
+    input_ids, attention_mask, targets = teacher_targets(teacher,codes)
+    del teacher
+
+    student = build_student(teacher_name,num_layers,hidden_size,num_attention_heads)
+    optimizer = torch.optim.AdamW(student.parameters(),lr=learning_rate)
+    steps = epochs*(-(-len(input_ids)//batch_size))
+    scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer,max_lr=learning_rate,total_steps=steps)
+    losses = []
+    student.train()
+    for epoch in range(epochs):
+        order = torch.randperm(len(input_ids))
+        total = 0.0
+        for start in range(0,len(order),batch_size):
+            batch = order[start:start+batch_size]
+            max_len = int(attention_mask[batch].sum(1).max())
+            mask = attention_mask[batch,:max_len]
+            pooled = masked_mean(student(input_ids[batch,:max_len],mask).last_hidden_state,mask)
+            # MSE keeps the scale of the teacher's vectors, the cosine term their direction.
+            loss = torch.nn.functional.mse_loss(pooled,targets[batch]) + \
+                   (1-torch.nn.functional.cosine_similarity(pooled,targets[batch])).mean()
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            total += loss.item()*len(batch)
+        losses.append(total/len(order))
+        print(f"Epoch {epoch+1}/{epochs}: loss {losses[-1]:.4f}")
+
+    student.eval()
+    os.makedirs(output_dir,exist_ok=True)
+    student.save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(teacher_name).save_pretrained(output_dir)
+    return losses
+
+def evaluate_student(teacher_name:str,student_path:str,repo_path:str):
+    from evaluation import timed_evaluation
+    results = {"teacher": timed_evaluation(EmbeddingGenerator(teacher_name),repo_path),
+               "student": timed_evaluation(EmbeddingGenerator(student_path),repo_path)}
+    # files_per_second gives the speedup, the classifier columns the F1 retention.
+    results["student / teacher"] = {name: results["student"][name]/results["teacher"][name] if results["teacher"][name] else 0.0
+                            for name in results["teacher"]}
+    return results
+
+if __name__ == "__main__":
+    import sys
+    from evaluation import print_results
+    teacher_name, output_dir, eval_repo, train_paths = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4:]
+    distill(teacher_name,train_paths,output_dir)
+    print_results(evaluate_student(teacher_name,output_dir,eval_repo))
@@ -0,0 +1,73 @@
+import hashlib,os,sqlite3,time
+import numpy as np
+from utils import lazy_import
+
+torch = lazy_import("torch")
+
+class EmbeddingCache:
+    def __init__(self,path:str,max_bytes:int=1<<30):
+        os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB, size INTEGER, last_used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(code:str,model_name:str,chunk_size:int,stride:int,pooling:str,chunking:str="window"):
+        header = f"{model_name}\0{chunk_size}\0{stride}\0{pooling}\0"
+        if chunking != "window":
+            header += f"{chunking}\0"
+        return hashlib.sha256((header+code).encode("utf-8","surrogatepass")).hexdigest()
+
+    @staticmethod
+    def make_chunk_key(input_ids:bytes,model_name:str,pooling:str):
+        return hashlib.sha256(f"{model_name}\0{pooling}\0".encode()+input_ids).hexdigest()
+
+    @property
+    def hit_rate(self):
+        total = self.hits+self.misses
+        return self.hits/total if total else 0.0
+
+    def get_many(self,keys:list):
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # Stay well below SQLite's bound-parameter limit.
+        for i in range(0,len(unique_keys),500):
+            batch = unique_keys[i:i+500]
+            rows = self.connection.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?'*len(batch))})",batch)
+            for key, vector in rows:
+                found[key] = torch.from_numpy(np.frombuffer(vector,dtype=np.float32).copy())
+        if found:
+            now = time.time()
+            self.connection.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",[(now,key) for key in found])
+            self.connection.commit()
+        self.hits += sum(key in found for key in keys)
+        self.misses += sum(key not in found for key in keys)
+        return found
+
+    def put_many(self,items:dict):
+        now = time.time()
+        rows = []
+        for key, vector in items.items():
+            data = vector.detach().to("cpu",torch.float32).numpy().tobytes()
+            rows.append((key,data,len(data),now))
+        self.connection.executemany("INSERT OR REPLACE INTO embeddings (key, vector, size, last_used) VALUES (?, ?, ?, ?)",rows)
+        self._evict()
+        self.connection.commit()
+
+    def _evict(self):
+        total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self.connection.execute("SELECT key, size FROM embeddings ORDER BY last_used"):
+            if total_bytes <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total_bytes -= size
+        self.connection.executemany("DELETE FROM embeddings WHERE key = ?",evicted)
+
+    def close(self):
+        self.connection.close()
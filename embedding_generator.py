@@ -1,75 +1,761 @@
-import torch,os
-from transformers import AutoTokenizer, AutoModel,T5EncoderModel
+from __future__ import annotations
+import os,re,json,queue,shutil,hashlib,inspect,tempfile,threading,itertools,warnings
+from collections import Counter, OrderedDict
+from contextlib import nullcontext
+from functools import cache
+from utils import lazy_import
+from embedding_cache import EmbeddingCache
+from hidden_state_store import HiddenStateStore
+from ast_chunker import unit_boundaries, pack_windows, definition_offsets, definition_spans
+from profiling import StageProfiler
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# torch and transformers take seconds to import; they are loaded on first use.
+torch = lazy_import("torch")
+transformers = lazy_import("transformers")
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"),".cache","pattern-classifier")
+MODEL_REGISTRY_DIR = os.path.join(CACHE_DIR,"models")
+# Every pooling reduces each chunk to one vector; a file's embedding is the mean of its chunk vectors.
+POOLINGS = ("last_hidden_state_mean","pooler_output_mean","cls","last_hidden_state_max","last_layers_mean")
+SAMPLINGS = ("head_tail","uniform","ast")
+DTYPES = {"fp32": "float32", "bf16": "bfloat16", "fp16": "float16"}
+
+_NO_STAGE = nullcontext()
+
+@cache
+def default_device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def model_cache_path(cache_dir:str,model_name:str,file_name:str):
+    return os.path.join(cache_dir,re.sub(r"[^\w.-]","_",model_name),file_name)
+
+def _load_pretrained(model_name:str,**kwargs):
+    config = transformers.AutoConfig.from_pretrained(model_name)
+    # Students saved by distillation.distill carry a projection to the teacher's size.
+    if getattr(config,"projection_size",None):
+        from distillation import StudentEncoder
+        return StudentEncoder.from_pretrained(model_name,**kwargs)
+    # T5-style checkpoints (CodeT5) are encoder-decoders; only the encoder is used.
+    if config.model_type in ("t5","mt5"):
+        return transformers.T5EncoderModel.from_pretrained(model_name,**kwargs)
+    return transformers.AutoModel.from_pretrained(model_name,**kwargs)
+
+def local_model_path(model_name:str,registry_dir:str=MODEL_REGISTRY_DIR):
+    # Offline-first model registry: local directories are used as they are; a
+    # hub model is fetched once, saved with its tokenizer as safetensors under
+    # registry_dir, and every later load reads that directory without any hub
+    # lookup. transformers memory-maps safetensors weights instead of unpickling them.
+    if os.path.isdir(model_name):
+        return model_name
+    path = os.path.dirname(model_cache_path(registry_dir,model_name,"config.json"))
+    if os.path.exists(os.path.join(path,"config.json")):
+        return path
+    # Every process saves into its own directory, so concurrent first loads
+    # (spawned workers) do not write over each other; the first rename wins.
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path),prefix=".tmp-")
+    try:
+        _load_pretrained(model_name).save_pretrained(tmp_path,safe_serialization=True)
+        transformers.AutoTokenizer.from_pretrained(model_name).save_pretrained(tmp_path)
+        os.replace(tmp_path,path)
+    except OSError:
+        if not os.path.exists(os.path.join(path,"config.json")):
+            raise
+    finally:
+        shutil.rmtree(tmp_path,ignore_errors=True)
+    return path
+
+def load_model(model_name:str,**kwargs):
+    return _load_pretrained(local_model_path(model_name),**kwargs)
+
+# Attribute paths of the transformer layer stack in the supported architectures.
+LAYER_STACKS = ("encoder.layer","h","encoder.block","layers")
+
+def truncate_layers(model:torch.nn.Module,num_layers:int):
+    # Keeps the first num_layers transformer layers in place, so the model's
+    # output is that intermediate layer and the deeper layers are never run.
+    for path in LAYER_STACKS:
+        try:
+            layers = model.get_submodule(path)
+        except AttributeError:
+            continue
+        if isinstance(layers,torch.nn.ModuleList):
+            if not 0 < num_layers <= len(layers):
+                raise ValueError(f"num_layers must be between 1 and {len(layers)}, got {num_layers}")
+            parent, _, name = path.rpartition(".")
+            setattr(model.get_submodule(parent),name,layers[:num_layers])
+            model.config.num_hidden_layers = num_layers
+            return model
+    raise ValueError(f"Cannot find the layer stack of {type(model).__name__} to truncate")
+
+def load_quantized_model(model_name:str,cache_dir:str=os.path.join(CACHE_DIR,"int8")):
+    # Dynamic int8 quantization of every Linear layer; the converted module is
+    # pickled so later runs skip the conversion.
+    path = model_cache_path(cache_dir,model_name,f"model_torch{torch.__version__}.pt")
+    if os.path.exists(path):
+        return torch.load(path,weights_only=False)
+    model = torch.ao.quantization.quantize_dynamic(load_model(model_name).eval(),{torch.nn.Linear},dtype=torch.qint8)
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),prefix=".tmp-")
+    try:
+        with os.fdopen(descriptor,"wb") as file:
+            torch.save(model,file)
+        os.replace(tmp_path,path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return model
+
+def resolve_dtype(dtype:str,device:torch.device):
+    # Reduced precision is used only if this device and torch build can run a
+    # Linear layer in it; otherwise inference falls back to fp32.
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype {dtype!r}, expected one of {tuple(DTYPES)}")
+    if dtype == "fp32":
+        return dtype
+    try:
+        torch.nn.Linear(8,8).to(device,getattr(torch,DTYPES[dtype]))(torch.ones(2,8,device=device,dtype=getattr(torch,DTYPES[dtype])))
+    except RuntimeError:
+        warnings.warn(f"{dtype} is not supported on {device}, falling back to fp32")
+        return "fp32"
+    return dtype
+
+def masked_mean(hidden_state,attention_mask):
+    expanded_attention_mask = attention_mask.unsqueeze(-1).expand(hidden_state.shape)
+    masked_embeddings = expanded_attention_mask * hidden_state
+    return masked_embeddings.sum(1)/ expanded_attention_mask.sum(1)
+
+def schedule_batches(lengths:list, batch_size:int):
+    # Sorting chunks by token length buckets similar lengths together, so each
+    # batch is padded to a length close to that of its own chunks.
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    return [order[i:i+batch_size] for i in range(0,len(order),batch_size)]
+
+def sample_windows(lengths:list, budget:int, sampling:str, scores:list=None):
+    # Picks the windows of a file to embed, in file order, so that their token
+    # lengths add up to at most `budget`. The first window is kept if nothing fits.
+    if sampling == "uniform":
+        count = max(1,min(len(lengths),budget//max(lengths)))
+        if count == 1:
+            return [0]
+        return sorted({round(i*(len(lengths)-1)/(count-1)) for i in range(count)})
+    if sampling == "head_tail":
+        order = [index for pair in zip(range(len(lengths)),reversed(range(len(lengths)))) for index in pair][:len(lengths)]
+        order = list(dict.fromkeys(order))
+    else:
+        order = sorted(range(len(lengths)),key=lambda index: (-scores[index],index))
+    kept, total = [], 0
+    for index in order:
+        if total+lengths[index] <= budget:
+            kept.append(index)
+            total += lengths[index]
+    return sorted(kept) or [order[0]]
 
 class EmbeddingGenerator:
-    def __init__(self,model_name:str="microsoft/codebert-base", chunk_size:int=128, stride:int=68):
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModel.from_pretrained(model_name).to(device)
+    def __init__(self,model_name:str="microsoft/codebert-base", chunk_size:int=128, stride:int=68, batch_size:int=32, cache:EmbeddingCache=None,
+                 dedup_chunks:bool=False, chunk_cache:EmbeddingCache=None, backend:str="torch",
+                 quantize:str=None, model:torch.nn.Module=None, pooling="last_hidden_state_mean", last_layers:int=4,
+                 hidden_state_store:HiddenStateStore=None, chunking:str="window", max_window_tokens:int=None,
+                 max_file_tokens:int=None, sampling:str="head_tail", num_layers:int=None, dtype:str="fp32",
+                 profiler:StageProfiler=None):
+        self.model_name = model_name
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(local_model_path(model_name))
+        self.device = default_device()
+        if quantize not in (None,"int8"):
+            raise ValueError(f"Unknown quantize mode {quantize!r}, expected None or 'int8'")
+        if quantize and backend != "torch":
+            raise ValueError("int8 quantization is only available with the torch backend")
+        if model is not None:
+            self.model = model.to(self.device)
+        elif quantize == "int8":
+            # Dynamically quantized kernels only run on CPU.
+            self.device = torch.device("cpu")
+            self.model = load_quantized_model(model_name)
+        elif backend == "torch":
+            self.model = load_model(model_name).to(self.device)
+        elif backend == "onnx":
+            from onnx_backend import OnnxEncoder
+            self.model = OnnxEncoder(model_name)
+        else:
+            raise ValueError(f"Unknown backend {backend!r}, expected 'torch' or 'onnx'")
+        if num_layers is not None:
+            if backend != "torch":
+                raise ValueError("num_layers is only available with the torch backend")
+            truncate_layers(self.model,num_layers)
+        self.num_layers = num_layers
+        # Weights and activations, pooling included, run in self.dtype; pooled
+        # vectors are returned in float32.
+        self.dtype = resolve_dtype(dtype,self.device)
+        if self.dtype != "fp32":
+            if backend != "torch" or quantize:
+                raise ValueError(f"dtype {dtype!r} is only available with the unquantized torch backend")
+            self.model = self.model.to(getattr(torch,DTYPES[self.dtype]))
+        # Truncated, quantized or reduced-precision models produce different vectors, so keys carry them.
+        self.model_key = model_name+(f"@{num_layers}" if num_layers is not None else "")+(f"@{self.dtype}" if self.dtype != "fp32" else "")+\
+                         (f"@{quantize}" if quantize else "")
         self.chunk_size = chunk_size
         self.stride = stride
+        self.batch_size = batch_size
+        # A single pooling name returns tensors; a list of names returns {name: tensor}
+        # dicts, all computed from the same forward pass.
+        self.pooling = pooling
+        self.poolings = (pooling,) if isinstance(pooling,str) else tuple(pooling)
+        self.last_layers = last_layers
+        self.cache = cache
+        self.dedup_chunks = dedup_chunks or chunk_cache is not None
+        self.chunk_cache = chunk_cache
+        self.chunk_memo = OrderedDict()
+        self.chunk_memo_size = 100000
+        self.hidden_state_store = hidden_state_store
+        self.stats = Counter()
+        self.last_sampled = []
+        self.profiler = profiler
+        if not self.tokenizer.is_fast:
+            raise ValueError(f"{model_name} has no fast tokenizer, which is required for windowed tokenization")
+        for name in self.poolings:
+            if name not in POOLINGS:
+                raise ValueError(f"Unknown pooling {name!r}, expected one of {POOLINGS}")
+        if not 0 < stride <= chunk_size:
+            raise ValueError(f"stride must be in (0, chunk_size], got {stride}")
         if self.tokenizer.pad_token is None:
           self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.tokenizer.padding_side = "right"
+        if chunking not in ("window","ast"):
+            raise ValueError(f"Unknown chunking {chunking!r}, expected 'window' or 'ast'")
+        # "ast" packs whole top-level statements into windows of up to
+        # max_window_tokens content tokens, by default the longest input the model takes.
+        self.chunking = chunking
+        if max_window_tokens is None:
+            max_positions = getattr(self.model.config,"max_position_embeddings",None) or self.tokenizer.model_max_length
+            max_window_tokens = min(self.tokenizer.model_max_length,max_positions)-self.tokenizer.num_special_tokens_to_add()
+        # Oversized statements are split into windows overlapping by chunk_size-stride tokens.
+        if chunking == "ast" and max_window_tokens <= chunk_size-stride:
+            raise ValueError(f"max_window_tokens must exceed the window overlap chunk_size-stride={chunk_size-stride}, got {max_window_tokens}")
+        self.max_window_tokens = max_window_tokens
+        self.chunking_key = "window" if chunking == "window" else f"ast{max_window_tokens}"
+        # Files whose windows hold more than max_file_tokens content tokens are
+        # sampled down to that budget, which bounds the cost of any single file.
+        if sampling not in SAMPLINGS:
+            raise ValueError(f"Unknown sampling {sampling!r}, expected one of {SAMPLINGS}")
+        self.max_file_tokens = max_file_tokens
+        self.sampling = sampling
+        if max_file_tokens is not None:
+            self.chunking_key += f"\0{sampling}{max_file_tokens}"
+        marked = self.tokenizer.build_inputs_with_special_tokens([-1])
+        self.special_prefix_length = marked.index(-1)
+        self.special_suffix_length = len(marked)-self.special_prefix_length-1
+
+    def _stage(self,name:str):
+        # Without a profiler every stage shares one no-op context manager.
+        return _NO_STAGE if self.profiler is None else self.profiler.stage(name)
+
+    def _tokenize(self,codes:list):
+        with self._stage("tokenize"):
+            encoding = self._encode(codes)
+        with self._stage("chunk"):
+            tokenized = self._chunk(codes,encoding)
+            # Per-file flags of this call, set by _sample.
+            self._sampled_flags = [False]*len(codes)
+            if self.max_file_tokens is not None:
+                tokenized = self._sample(codes,*tokenized)
+        return tokenized
+
+    def _encode(self,codes:list):
+        if self.chunking == "ast":
+            return self.tokenizer(list(codes),add_special_tokens=False,return_offsets_mapping=True)
+        # One fast-tokenizer call windows every file: consecutive windows start
+        # `stride` tokens apart and carry the model's special tokens.
+        return self.tokenizer(list(codes), max_length=self.chunk_size+self.tokenizer.num_special_tokens_to_add(),
+                              truncation=True, stride=self.chunk_size-self.stride, return_overflowing_tokens=True,
+                              padding=True, return_tensors='np')
+
+    def _chunk(self,codes:list,encoding):
+        return self._tokenize_ast(codes,encoding) if self.chunking == "ast" else self._tokenize_windows(codes,encoding)
+
+    def _tokenize_windows(self,codes:list,encoding):
+        input_ids = torch.from_numpy(encoding['input_ids'])
+        attention_mask = torch.from_numpy(encoding['attention_mask'])
+        chunk_counts = torch.bincount(torch.from_numpy(encoding['overflow_to_sample_mapping']),minlength=len(codes)).tolist()
+        if len(input_ids) == len(codes):
+            return input_ids, attention_mask, chunk_counts, [0]*len(codes)
+
+        content_mask = (attention_mask == 1) & ~torch.isin(input_ids,torch.tensor(self.tokenizer.all_special_ids))
+        content_lengths = content_mask.sum(1).tolist()
+        prefix_lengths = content_mask.int().argmax(1).tolist()
+
+        # The sliding window starts a new chunk every `stride` tokens until the end
+        # of the file, while the tokenizer stops at the first window reaching it.
+        # Those trailing chunks are suffixes of the tokenizer's last window.
+        ids_rows, mask_rows, index = [input_ids], [attention_mask], []
+        offset, next_row = 0, len(input_ids)
+        for file_index, count in enumerate(chunk_counts):
+            index.extend(range(offset,offset+count))
+            last = offset+count-1
+            total_length = (count-1)*self.stride+content_lengths[last]
+            extra = -(-total_length//self.stride)-count if total_length > self.chunk_size else 0
+            for j in range(1,extra+1):
+                keep = torch.ones(input_ids.shape[1],dtype=torch.bool)
+                keep[prefix_lengths[last]:prefix_lengths[last]+j*self.stride] = False
+                ids_rows.append(torch.nn.functional.pad(input_ids[last][keep],(0,j*self.stride),value=self.tokenizer.pad_token_id)[None])
+                mask_rows.append(torch.nn.functional.pad(attention_mask[last][keep],(0,j*self.stride))[None])
+                index.append(next_row)
+                next_row += 1
+            chunk_counts[file_index] += extra
+            offset += count
+
+        if next_row > len(input_ids):
+            input_ids, attention_mask = torch.cat(ids_rows)[index], torch.cat(mask_rows)[index]
+        window_starts = [i*self.stride for count in chunk_counts for i in range(count)]
+        return input_ids, attention_mask, chunk_counts, window_starts
+
+    def _tokenize_ast(self,codes:list,encoding):
+        rows, chunk_counts, window_starts = [], [], []
+        for code, ids, offsets in zip(codes,encoding['input_ids'],encoding['offset_mapping']):
+            windows = pack_windows([start for start, _ in offsets],unit_boundaries(code),self.max_window_tokens,self.chunk_size-self.stride)
+            rows.extend(self.tokenizer.build_inputs_with_special_tokens(ids[start:end]) for start, end in windows)
+            window_starts.extend(start for start, _ in windows)
+            chunk_counts.append(len(windows))
+        max_len = max(len(row) for row in rows)
+        input_ids = torch.full((len(rows),max_len),self.tokenizer.pad_token_id,dtype=torch.long)
+        attention_mask = torch.zeros((len(rows),max_len),dtype=torch.long)
+        for i, row in enumerate(rows):
+            input_ids[i,:len(row)] = torch.tensor(row)
+            attention_mask[i,:len(row)] = 1
+        return input_ids, attention_mask, chunk_counts, window_starts
+
+    def _content_lengths(self,attention_mask):
+        return (attention_mask.sum(1)-self.special_prefix_length-self.special_suffix_length).tolist()
+
+    def _sample(self,codes:list,input_ids,attention_mask,chunk_counts:list,window_starts:list):
+        lengths = self._content_lengths(attention_mask)
+        rows, sampled_counts, offset = [], [], 0
+        for file_index, (code, count) in enumerate(zip(codes,chunk_counts)):
+            file_lengths = lengths[offset:offset+count]
+            if sum(file_lengths) <= self.max_file_tokens:
+                kept = range(count)
+            else:
+                scores = None
+                if self.sampling == "ast":
+                    # Windows are ranked by the class and function definitions starting in them.
+                    offsets = [start for start, _ in self.tokenizer(code,add_special_tokens=False,return_offsets_mapping=True)['offset_mapping']]
+                    definitions = definition_offsets(code)
+                    scores = []
+                    for start, length in zip(window_starts[offset:offset+count],file_lengths):
+                        first = offsets[start] if start < len(offsets) else len(code)
+                        last = offsets[start+length] if start+length < len(offsets) else len(code)
+                        scores.append(sum(first <= definition < last for definition in definitions))
+                kept = sample_windows(file_lengths,self.max_file_tokens,self.sampling,scores)
+                self.stats['sampled_files'] += 1
+                self._sampled_flags[file_index] = True
+            rows.extend(offset+index for index in kept)
+            sampled_counts.append(len(kept))
+            offset += count
+        if len(rows) == len(input_ids):
+            return input_ids, attention_mask, chunk_counts, window_starts
+        return input_ids[rows], attention_mask[rows], sampled_counts, [window_starts[row] for row in rows]
+
+    def sampled(self,codes:list):
+        # Flags the files whose embedding only covers a sample of their windows,
+        # without embedding them; embedding calls report the same flags themselves.
+        if self.max_file_tokens is None:
+            return [False]*len(codes)
+        _, attention_mask, chunk_counts, _ = self._chunk(codes,self._encode(codes))
+        lengths = torch.tensor(self._content_lengths(attention_mask))
+        return [int(file_lengths.sum()) > self.max_file_tokens for file_lengths in torch.split(lengths,chunk_counts)]
+
+    def _forward(self,input_ids,attention_mask,output_hidden_states:bool=False):
+        max_len = int(attention_mask.sum(1).max())
+        self.stats['real_tokens'] += int(attention_mask.sum())
+        self.stats['padded_tokens'] += max_len*len(input_ids)
+        self.stats['chunks_embedded'] += len(input_ids)
+        with self._stage("to_device"):
+            inputs = {'input_ids': input_ids[:,:max_len].to(self.device), 'attention_mask': attention_mask[:,:max_len].to(self.device)}
+        with torch.no_grad(), self._stage("forward"):
+            if output_hidden_states:
+                return self.model(**inputs,output_hidden_states=True), inputs['attention_mask']
+            return self.model(**inputs), inputs['attention_mask']
+
+    def _embed_chunks(self,input_ids,attention_mask):
+        store = self.hidden_state_store
+        outputs, mask = self._forward(input_ids,attention_mask,"last_layers_mean" in self.poolings or (store is not None and store.layers > 1))
+        if store is not None:
+            with self._stage("store"):
+                if store.layers == 1:
+                    hidden_states = outputs.last_hidden_state.unsqueeze(2)
+                elif getattr(outputs,"hidden_states",None) is None:
+                    raise ValueError(f"{self.model_name} does not expose per-layer hidden states")
+                else:
+                    hidden_states = torch.stack(outputs.hidden_states[-store.layers:],2)
+                window_keys = [store.window_key(window,self.model_key) for window in self._windows(input_ids,attention_mask)]
+                store.add_windows(window_keys,input_ids,attention_mask,hidden_states)
+        with self._stage("pool"):
+            return self._pool(outputs,mask)
+
+    def generate_span_embeddings(self,code:str,pooling:str="last_hidden_state_mean"):
+        # One vector per class and function of `code`, with its line range. The
+        # file's windows are encoded once; each content token's hidden state is
+        # averaged over the windows that contain it and every span is the mean
+        # of the tokens its lines cover, mapped through the offset mapping.
+        # With max_file_tokens the file's windows are sampled as for file
+        # embeddings: "sampled" marks spans with tokens outside the embedded
+        # windows, and spans with none inside have embedding None.
+        if pooling not in ("last_hidden_state_mean","last_layers_mean"):
+            raise ValueError(f"Span pooling supports last_hidden_state_mean and last_layers_mean, got {pooling!r}")
+        spans = definition_spans(code)
+        if not spans:
+            return []
+        input_ids, attention_mask, _, window_starts = self._tokenize([code])
+        offsets = [start for start, _ in self.tokenizer(code,add_special_tokens=False,return_offsets_mapping=True)['offset_mapping']]
+        token_sums = torch.zeros(len(offsets),self.model.config.hidden_size,dtype=torch.float64)
+        token_counts = torch.zeros(len(offsets),dtype=torch.float64)
+        for batch in schedule_batches(attention_mask.sum(1).tolist(),self.batch_size):
+            outputs, mask = self._forward(input_ids[batch],attention_mask[batch],pooling == "last_layers_mean")
+            with self._stage("pool"):
+                if pooling == "last_layers_mean":
+                    hidden = torch.stack(outputs.hidden_states[-self.last_layers:]).mean(0)
+                else:
+                    hidden = outputs.last_hidden_state
+                for window, row, length in zip(batch,hidden.cpu(),mask.sum(1).tolist()):
+                    content = row[self.special_prefix_length:length-self.special_suffix_length].double()
+                    positions = window_starts[window]+torch.arange(len(content))
+                    token_sums.index_add_(0,positions,content)
+                    token_counts.index_add_(0,positions,torch.ones(len(content),dtype=torch.float64))
+
+        offsets = torch.tensor(offsets)
+        embeddings = []
+        for kind, name, start_line, end_line, start, end in spans:
+            span_tokens = (offsets >= start) & (offsets < end)
+            tokens = span_tokens & (token_counts > 0)
+            embedding = (token_sums[tokens]/token_counts[tokens,None]).mean(0).float() if tokens.any() else None
+            embeddings.append({"kind": kind, "name": name, "start_line": start_line, "end_line": end_line, "embedding": embedding,
+                               "sampled": bool((span_tokens & (token_counts == 0)).any())})
+        return embeddings
+
+    def _windows(self,input_ids,attention_mask):
+        return [ids[:length].numpy().tobytes() for ids, length in zip(input_ids,attention_mask.sum(1).tolist())]
+
+    def _source_key(self,code:str):
+        return HiddenStateStore.source_key(code,self.model_key,self.chunk_size,self.stride,self.chunking_key)
 
+    def _record_sources(self,codes:list,input_ids,attention_mask,chunk_counts:list,window_starts:list):
+        store = self.hidden_state_store
+        window_keys = [store.window_key(window,self.model_key) for window in self._windows(input_ids,attention_mask)]
+        offset = 0
+        for code, count in zip(codes,chunk_counts):
+            store.add_source(self._source_key(code),window_keys[offset:offset+count],window_starts[offset:offset+count],
+                             self.special_prefix_length,self.special_suffix_length)
+            offset += count
+
+    def _pool(self,outputs,attention_mask):
+        pooled = {}
+        for name in self.poolings:
+            if name == "last_hidden_state_mean":
+                pooled[name] = masked_mean(outputs.last_hidden_state,attention_mask)
+            elif name == "pooler_output_mean":
+                if getattr(outputs,"pooler_output",None) is None:
+                    raise ValueError(f"{self.model_name} does not produce a pooler output")
+                pooled[name] = outputs.pooler_output
+            elif name == "cls":
+                pooled[name] = outputs.last_hidden_state[:,0]
+            elif name == "last_hidden_state_max":
+                padding = (attention_mask == 0).unsqueeze(-1)
+                pooled[name] = outputs.last_hidden_state.masked_fill(padding,float("-inf")).max(1).values
+            elif name == "last_layers_mean":
+                if getattr(outputs,"hidden_states",None) is None:
+                    raise ValueError(f"{self.model_name} does not expose per-layer hidden states")
+                pooled[name] = masked_mean(torch.stack(outputs.hidden_states[-self.last_layers:]).mean(0),attention_mask)
+        return {name: vectors.float() for name, vectors in pooled.items()}
+
+    def _embed_unique_chunks(self,input_ids,attention_mask,batch_size:int):
+        # Identical token windows (licence headers, imports, __main__ blocks...)
+        # are embedded once and reused within the batch, across calls through
+        # chunk_memo and across runs through chunk_cache.
+        lengths = attention_mask.sum(1).tolist()
+        windows = self._windows(input_ids,attention_mask)
+        keys = {name: [EmbeddingCache.make_chunk_key(window,self.model_key,self._pooling_key(name)) for window in windows] for name in self.poolings}
+        unique_rows = {}
+        for row, window in enumerate(windows):
+            unique_rows.setdefault(window,row)
+
+        vectors = {}
+        for row in unique_rows.values():
+            for name in self.poolings:
+                key = keys[name][row]
+                if key in self.chunk_memo:
+                    self.chunk_memo.move_to_end(key)
+                    vectors[key] = self.chunk_memo[key]
+        if self.chunk_cache is not None:
+            vectors.update(self.chunk_cache.get_many([keys[name][row] for row in unique_rows.values() for name in self.poolings
+                                                      if keys[name][row] not in vectors]))
+
+        rows = [row for row in unique_rows.values() if any(keys[name][row] not in vectors for name in self.poolings)
+                or (self.hidden_state_store is not None and not self.hidden_state_store.covers(self.hidden_state_store.window_key(windows[row],self.model_key)))]
+        computed = {}
+        for batch in schedule_batches([lengths[row] for row in rows],batch_size):
+            batch_rows = [rows[i] for i in batch]
+            for name, pooled in self._embed_chunks(input_ids[batch_rows],attention_mask[batch_rows]).items():
+                for row, vector in zip(batch_rows,pooled):
+                    computed[keys[name][row]] = vector
+        if computed and self.chunk_cache is not None:
+            self.chunk_cache.put_many(computed)
+        vectors.update(computed)
+
+        for row in unique_rows.values():
+            for name in self.poolings:
+                self.chunk_memo[keys[name][row]] = vectors[keys[name][row]]
+        while len(self.chunk_memo) > self.chunk_memo_size:
+            self.chunk_memo.popitem(last=False)
+        return {name: torch.stack([vectors[key].to(self.device) for key in keys[name]]) for name in self.poolings}
+
+    @property
+    def padding_efficiency(self):
+        return self.stats['real_tokens']/self.stats['padded_tokens'] if self.stats['padded_tokens'] else 1.0
+
+    @property
+    def dedup_ratio(self):
+        return 1-self.stats['chunks_embedded']/self.stats['chunks'] if self.stats['chunks'] else 0.0
+
+    @property
+    def _outputs(self):
+        # When files can be sampled, a per-file 0/1 "sampled" flag is computed and
+        # cached next to the pooled vectors, so cache hits still report it.
+        return self.poolings+("sampled",) if self.max_file_tokens is not None else self.poolings
+
+    def _sampled(self,embeddings:dict,count:int):
+        return embeddings["sampled"].flatten().bool().tolist() if "sampled" in embeddings else [False]*count
+
+    def _cached(self,codes:list,compute):
+        # Only sources whose (text, model, chunking, pooling) keys are not all
+        # cached are handed to `compute`; the rest are served from the cache.
+        if self.cache is None or not codes:
+            return compute(codes)
+        keys = {name: [self._cache_key(code,name) for code in codes] for name in self._outputs}
+        embeddings = self.cache.get_many([key for name in self._outputs for key in keys[name]])
+        missing = {}
+        store = self.hidden_state_store
+        for index, code in enumerate(codes):
+            if any(keys[name][index] not in embeddings for name in self._outputs) or \
+                    (store is not None and not store.has_source(self._source_key(code))):
+                missing.setdefault(code,index)
+        if missing:
+            computed = compute(list(missing))
+            new_embeddings = {}
+            for position, index in enumerate(missing.values()):
+                for name in self._outputs:
+                    new_embeddings[keys[name][index]] = computed[name][position]
+            self.cache.put_many(new_embeddings)
+            embeddings.update(new_embeddings)
+        return {name: torch.stack([embeddings[key].to(self.device) for key in keys[name]]) for name in self._outputs}
+
+    def _unwrap(self,embeddings:dict):
+        return embeddings[self.pooling] if isinstance(self.pooling,str) else {name: embeddings[name] for name in self.poolings}
+
+    def _pooling_key(self,pooling:str):
+        # last_layers_mean averages a different number of layers per generator.
+        return f"{pooling}@{self.last_layers}" if pooling == "last_layers_mean" else pooling
+
+    def _cache_key(self,code:str,pooling:str):
+        return EmbeddingCache.make_key(code,self.model_key,self.chunk_size,self.stride,self._pooling_key(pooling),self.chunking_key)
+
+    def embedding_keys(self,code:str):
+        # {pooling: embedding cache key} under which this generator stores code's
+        # embedding, plus the key of its "sampled" flag when files can be sampled.
+        return {name: self._cache_key(code,name) for name in self._outputs}
+
+    # generate_embedding(s) leave the sampled flag of each file in last_sampled.
     def generate_embedding(self,code:str):
-        all_tokens = self.tokenizer.encode(code, add_special_tokens=False)
-        total_length = len(all_tokens)
+        def compute(codes):
+            return {name: embedding.unsqueeze(0) for name, embedding in self._generate_embedding(codes[0]).items()}
+        embeddings = self._cached([code],compute)
+        self.last_sampled = self._sampled(embeddings,1)
+        return self._unwrap({name: embeddings[0] for name, embeddings in embeddings.items()})
+
+    def generate_embeddings(self,codes:list,batch_size:int=None):
+        codes = list(codes)
+        embeddings = self._cached(codes,lambda codes: self._generate_embeddings(codes,batch_size))
+        self.last_sampled = self._sampled(embeddings,len(codes))
+        return self._unwrap(embeddings)
+
+    def stream_embeddings(self,sources,files_per_batch:int=None,prefetch:int=2,with_sampled:bool=False):
+        # A background thread pulls (id, source) pairs into groups while the model
+        # embeds the previous group. At most `prefetch` groups wait in the queue,
+        # so memory stays bounded however long `sources` is. with_sampled yields
+        # (id, embedding, sampled) triples.
+        files_per_batch = files_per_batch or self.batch_size
+        groups = queue.Queue(maxsize=max(prefetch,1))
+        stop = threading.Event()
 
-        if total_length <= self.chunk_size:
-            inputs = self.tokenizer(code,return_tensors='pt')
+        def put(item):
+            while not stop.is_set():
+                try:
+                    groups.put(item,timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def produce():
+            try:
+                iterator = iter(sources)
+                while not stop.is_set():
+                    group = list(itertools.islice(iterator,files_per_batch))
+                    if not group:
+                        break
+                    put(group)
+                put(None)
+            except BaseException as error:
+                put(error)
+
+        threading.Thread(target=produce,daemon=True).start()
+        try:
+            while True:
+                group = groups.get()
+                if group is None:
+                    return
+                if isinstance(group,BaseException):
+                    raise group
+                embeddings = self._cached([source for _, source in group],self._generate_embeddings)
+                flags = self._sampled(embeddings,len(group))
+                for index, (source_id, _) in enumerate(group):
+                    embedding = self._unwrap({name: embeddings[name][index] for name in self.poolings})
+                    yield (source_id, embedding, flags[index]) if with_sampled else (source_id, embedding)
+        finally:
+            stop.set()
+
+    def _generate_embedding(self,code:str):
+        input_ids, attention_mask, _, window_starts = self._tokenize([code])
+        self.stats['chunks'] += len(input_ids)
+        if self.dedup_chunks:
+            chunk_embeddings = self._embed_unique_chunks(input_ids,attention_mask,self.batch_size)
+            code_embedding = {name: embeddings.mean(0) for name, embeddings in chunk_embeddings.items()}
         else:
-            chunks = []
-            for i in range(0,total_length,self.stride):
-                chunk = all_tokens[i:i+self.chunk_size]
-                chunks.append(chunk)
-            input_ids = [self.tokenizer.build_inputs_with_special_tokens(chunk) for chunk in chunks]
-            max_len = max(len(ids) for ids in input_ids)
-            attention_masks = []
-            padded_input_ids = []
-            for chunk in input_ids:
-                padding_length = max_len - len(chunk)
-                padded_input_ids.append(chunk+[self.tokenizer.pad_token_id]*padding_length)
-                attention_masks.append([1]*len(chunk)+[0]*padding_length)
-            inputs = {'input_ids': torch.tensor(padded_input_ids), 'attention_mask': torch.tensor(attention_masks)}
-
-        inputs = {k: v.to(device) for k, v in inputs.items()}
-
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-
-        expanded_attention_mask = inputs['attention_mask'].unsqueeze(-1).expand(outputs.last_hidden_state.shape)
-        masked_embeddings = expanded_attention_mask * outputs.last_hidden_state
-        code_embedding = (masked_embeddings.sum(1)/ expanded_attention_mask.sum(1)).mean(0)
+            # Chunks go through the model batch_size at a time and only running sums
+            # of their pooled vectors are kept, so peak memory does not grow with
+            # the file. Summing in float64 keeps the mean equal to the one-batch mean.
+            sums = {}
+            for start in range(0,len(input_ids),self.batch_size):
+                batch = slice(start,start+self.batch_size)
+                for name, pooled in self._embed_chunks(input_ids[batch],attention_mask[batch]).items():
+                    sums[name] = sums.get(name,0)+pooled.sum(0,dtype=torch.float64)
+            code_embedding = {name: (total/len(input_ids)).float() for name, total in sums.items()}
+        if self.hidden_state_store is not None:
+            self._record_sources([code],input_ids,attention_mask,[len(input_ids)],window_starts)
+        if self.max_file_tokens is not None:
+            code_embedding["sampled"] = torch.tensor([float(self._sampled_flags[0])],device=self.device)
 
         return code_embedding
+
+    def _generate_embeddings(self,codes:list,batch_size:int=None):
+        # Chunks of all files share forward batches, scheduled by token length;
+        # each file's chunk vectors are then averaged exactly as generate_embedding does.
+        batch_size = batch_size or self.batch_size
+        if not codes:
+            embeddings = {name: torch.empty(0,self.model.config.hidden_size,device=self.device) for name in self.poolings}
+            if self.max_file_tokens is not None:
+                embeddings["sampled"] = torch.empty(0,1,device=self.device)
+            return embeddings
+        input_ids, attention_mask, chunk_counts, window_starts = self._tokenize(codes)
+        sampled = self._sampled_flags
+        self.stats['chunks'] += len(input_ids)
+
+        if self.dedup_chunks:
+            chunk_embeddings = self._embed_unique_chunks(input_ids,attention_mask,batch_size)
+        else:
+            chunk_embeddings = {name: torch.empty(len(input_ids),self.model.config.hidden_size,device=self.device) for name in self.poolings}
+            for batch in schedule_batches(attention_mask.sum(1).tolist(),batch_size):
+                for name, pooled in self._embed_chunks(input_ids[batch],attention_mask[batch]).items():
+                    chunk_embeddings[name][batch] = pooled
+        if self.hidden_state_store is not None:
+            self._record_sources(codes,input_ids,attention_mask,chunk_counts,window_starts)
+
+        embeddings = {name: torch.stack([file_chunks.mean(0) for file_chunks in torch.split(embeddings,chunk_counts)])
+                      for name, embeddings in chunk_embeddings.items()}
+        if self.max_file_tokens is not None:
+            embeddings["sampled"] = torch.tensor(sampled,dtype=torch.float32,device=self.device).unsqueeze(1)
+        return embeddings
     
    
 
+# EmbeddingGenerator arguments that change neither the vectors nor their keys.
+RUNTIME_ARGUMENTS = ("cache","chunk_cache","hidden_state_store","profiler","model","dedup_chunks","batch_size")
+
+def config_fingerprint(**generator_kwargs):
+    # Digest of every EmbeddingGenerator argument that affects the vectors,
+    # defaults included, computed without loading the model or tokenizer.
+    arguments = inspect.signature(EmbeddingGenerator).bind(**generator_kwargs)
+    arguments.apply_defaults()
+    settings = {name: value for name, value in arguments.arguments.items() if name not in RUNTIME_ARGUMENTS}
+    return hashlib.sha256(json.dumps(settings,sort_keys=True,default=str).encode()).hexdigest()
+
 if __name__ == "__main__":
-    from utils import get_all_python_files, load_code_from_file,get_folders
+    from utils import SourceReader
+    from corpus_manifest import CorpusManifest
     import pandas as pd
     repo_path = "/home/hasinthaka/Documents/Projects/AI/AI Pattern Mining/Pattern Validator/reposistories/AI Patterns"
+    output_csv = f"{repo_path}/embeddings/embeddings_codetgpt_py.csv"
 
-    embedding_generator = EmbeddingGenerator(model_name="microsoft/CodeGPT-small-py")
-    patterns = get_folders(repo_path)
+    generator_kwargs = {"model_name": "microsoft/CodeGPT-small-py", "dedup_chunks": True}
 
-    embedding_size = embedding_generator.model.config.hidden_size
+    # Only files added or changed since the manifest was last written are embedded;
+    # files recorded under other generator settings count as changed.
+    manifest = CorpusManifest(f"{repo_path}/embeddings/manifest.sqlite",config_fingerprint(**generator_kwargs))
+    diff = manifest.scan(repo_path)
+    print(f"{len(diff['added'])} added, {len(diff['changed'])} changed, {len(diff['deleted'])} deleted, {len(diff['unchanged'])} unchanged")
+    if not (diff['added'] or diff['changed'] or diff['deleted']) and os.path.exists(output_csv):
+        print("Embeddings are up to date")
+        raise SystemExit
 
-    columns = ["pattern"]+[f'dim_{i}' for i in range(embedding_size)]
-    embeddings_df = pd.DataFrame(columns=columns)
+    embedding_cache = EmbeddingCache(f"{repo_path}/embeddings/cache.sqlite")
+    embedding_generator = EmbeddingGenerator(**generator_kwargs,cache=embedding_cache,profiler=StageProfiler())
+    source_reader = SourceReader()
 
-    for pattern in patterns:
-        if pattern == "embeddings":
-            continue
-        print("Processing pattern:", pattern)
-        python_files = get_all_python_files(repo_path+"/"+pattern)
-        for file in python_files:
-            code = load_code_from_file(file)
-            embeddings = embedding_generator.generate_embedding(code)
-            print("Computed embeddings for file:", file)
-            embeddings_df.loc[len(embeddings_df)] = [pattern]+embeddings.tolist()
+    def embed(paths):
+        keys = {}
+        def keyed(sources):
+            for path, code in sources:
+                keys[path] = embedding_generator.embedding_keys(code)
+                yield path, code
+        for path, _ in embedding_generator.stream_embeddings(keyed(source_reader.read(paths))):
+            print("Computed embeddings for file:", path)
+        # Files the reader skipped (too large, unreadable) are recorded without
+        # keys, so they are not reported as added again until they change.
+        manifest.record({path: keys.get(path,{}) for path in paths})
+
+    embed([path for path, _ in diff['added']+diff['changed']])
+    manifest.remove(diff['deleted'])
+
+    # Rows come from the cache; files whose vectors were evicted are embedded again.
+    entries = list(manifest.entries())
+    pooling = embedding_generator.pooling
+    missing = [path for path, _, keys in entries if keys and pooling not in keys]
+    vectors = embedding_cache.get_many([key for _, _, keys in entries for name, key in keys.items() if name in (pooling,"sampled")])
+    missing += [path for path, _, keys in entries if pooling in keys and keys[pooling] not in vectors]
+    if missing:
+        embed(missing)
+        missing = set(missing)
+        entries = list(manifest.entries())
+        vectors.update(embedding_cache.get_many([key for path, _, keys in entries if path in missing
+                                                 for name, key in keys.items() if name in (pooling,"sampled")]))
+
+    # With max_file_tokens, "sampled" marks files whose embedding only covers a
+    # sample of their windows. It is left out otherwise, as every consumer of
+    # the CSV treats all columns but "pattern" as features.
+    def sampled(keys):
+        return "sampled" in keys and keys["sampled"] in vectors and bool(vectors[keys["sampled"]].item())
+
+    embedding_size = embedding_generator.model.config.hidden_size
+    flagged = embedding_generator.max_file_tokens is not None
+    columns = ["pattern"]+["sampled"]*flagged+[f'dim_{i}' for i in range(embedding_size)]
+    embeddings_df = pd.DataFrame([[label]+[sampled(keys)]*flagged+vectors[keys[pooling]].tolist() for _, label, keys in entries
+                                  if keys.get(pooling) in vectors],columns=columns)
+
+    print(f"Padding efficiency: {embedding_generator.padding_efficiency:.2%}")
+    print(f"Embedding cache: {embedding_cache.hits} hits, {embedding_cache.misses} misses")
+    print(f"Chunk dedup ratio: {embedding_generator.dedup_ratio:.2%}")
+    if flagged:
+        print(f"Sampled files: {int(embeddings_df['sampled'].sum())} in the CSV, {embedding_generator.stats['sampled_files']} this run")
+    embedding_generator.profiler.print_summary(embedding_generator.stats)
+    print(source_reader.report())
 
     os.makedirs(f"{repo_path}/embeddings",exist_ok=True)
 
-    embeddings_df.to_csv(f"{repo_path}/embeddings/embeddings_codetgpt_py.csv",index=False)
\ No newline at end of file
+    embeddings_df.to_csv(output_csv,index=False)
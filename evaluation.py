@@ -0,0 +1,136 @@
+import json,os,subprocess,sys,time
+import numpy as np
+import torch
+import pandas as pd
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import LabelEncoder
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.svm import SVC
+from sklearn.metrics import f1_score
+from embedding_generator import DTYPES, EmbeddingGenerator, load_model
+from utils import get_all_python_files, load_code_from_file, get_folders
+
+def embed_patterns(embedding_generator:EmbeddingGenerator,repo_path:str):
+    rows = []
+    for pattern in get_folders(repo_path):
+        if pattern == "embeddings":
+            continue
+        codes = [load_code_from_file(file) for file in get_all_python_files(os.path.join(repo_path,pattern))]
+        for embedding in embedding_generator.generate_embeddings(codes):
+            rows.append([pattern]+embedding.tolist())
+    columns = ["pattern"]+[f'dim_{i}' for i in range(embedding_generator.model.config.hidden_size)]
+    return pd.DataFrame(rows,columns=columns)
+
+def evaluate_classifiers(data:pd.DataFrame):
+    # Same split and classifiers as Experiments/03_pattern_classiffier.ipynb.
+    labels = LabelEncoder().fit_transform(data['pattern'])
+    X = data.drop(columns=['pattern'])
+    X_train, X_test, y_train, y_test = train_test_split(X, labels, test_size=0.2, random_state=42)
+    classifiers = {"KNN": KNeighborsClassifier(n_neighbors=5),
+                   "RandomForest": RandomForestClassifier(n_estimators=5, random_state=42),
+                   "SVC": SVC(kernel='linear', random_state=42)}
+    scores = {}
+    for name, classifier in classifiers.items():
+        classifier.fit(X_train, y_train)
+        scores[name] = f1_score(y_test, classifier.predict(X_test), average="weighted")
+    return scores
+
+def timed_evaluation(embedding_generator:EmbeddingGenerator,repo_path:str):
+    start = time.perf_counter()
+    data = embed_patterns(embedding_generator,repo_path)
+    files_per_second = len(data)/(time.perf_counter()-start)
+    return {"files_per_second": files_per_second, **evaluate_classifiers(data)}
+
+def compare_quantized(model_name:str,repo_path:str):
+    return {quantize or "fp32": timed_evaluation(EmbeddingGenerator(model_name,quantize=quantize),repo_path)
+            for quantize in (None,"int8")}
+
+def compare_chunking(model_name:str,repo_path:str):
+    # Forward tokens are the real (unpadded) tokens sent through the model.
+    results = {}
+    for chunking in ("window","ast"):
+        generator = EmbeddingGenerator(model_name,chunking=chunking)
+        results[chunking] = timed_evaluation(generator,repo_path)
+        results[chunking]["forward_tokens"] = generator.stats['real_tokens']
+    results["ast"]["token_reduction"] = 1-results["ast"]["forward_tokens"]/results["window"]["forward_tokens"]
+    results["window"]["token_reduction"] = 0.0
+    return results
+
+def sweep_depth(model_name:str,repo_path:str,depths:list=None):
+    # One model is loaded and truncated from the deepest to the shallowest
+    # depth; truncation only drops layers, so each step reuses the previous one.
+    model = load_model(model_name)
+    depths = sorted(depths or range(1,model.config.num_hidden_layers+1),reverse=True)
+    return {f"{depth} layers": timed_evaluation(EmbeddingGenerator(model_name,model=model,num_layers=depth),repo_path)
+            for depth in depths}
+
+def compare_dtypes(model_name:str,repo_path:str):
+    # Numeric parity of each dtype against the fp32 embeddings, plus files/s and F1.
+    results, reference = {}, None
+    for dtype in DTYPES:
+        generator = EmbeddingGenerator(model_name,dtype=dtype)
+        start = time.perf_counter()
+        data = embed_patterns(generator,repo_path)
+        files_per_second = len(data)/(time.perf_counter()-start)
+        vectors = torch.tensor(data.drop(columns=['pattern']).values)
+        if reference is None:
+            reference = vectors
+        results[generator.dtype] = {"files_per_second": files_per_second,
+                                    "max_abs_diff": (vectors-reference).abs().max().item(),
+                                    "min_cosine": torch.nn.functional.cosine_similarity(vectors,reference).min().item(),
+                                    **evaluate_classifiers(data)}
+    return results
+
+def file_latencies(embedding_generator:EmbeddingGenerator,codes:list):
+    # Per-file generate_embedding latency in seconds, largest files included.
+    latencies = []
+    for code in codes:
+        start = time.perf_counter()
+        embedding_generator.generate_embedding(code)
+        latencies.append(time.perf_counter()-start)
+    return {"p50": float(np.percentile(latencies,50)), "p99": float(np.percentile(latencies,99)), "max": max(latencies)}
+
+def compare_sampling(model_name:str,repo_path:str,max_file_tokens:int=2048):
+    codes = [load_code_from_file(file) for file in get_all_python_files(repo_path)]
+    results = {"full": file_latencies(EmbeddingGenerator(model_name),codes)}
+    for sampling in ("head_tail","uniform","ast"):
+        generator = EmbeddingGenerator(model_name,max_file_tokens=max_file_tokens,sampling=sampling)
+        results[sampling] = {**file_latencies(generator,codes),"sampled_files": generator.stats['sampled_files']}
+    return results
+
+_STARTUP_SCRIPT = """
+import json,time
+start = time.perf_counter()
+import embedding_generator
+imported = time.perf_counter()
+generator = embedding_generator.EmbeddingGenerator({model_name!r})
+loaded = time.perf_counter()
+generator.generate_embedding("def f():\\n    return 1")
+done = time.perf_counter()
+print(json.dumps({{"import": imported-start, "load": loaded-imported, "first_embedding": done-loaded}}))
+"""
+
+def startup_benchmark(model_name:str,runs:int=3):
+    # Each run is a fresh interpreter, as for a CLI or pre-commit invocation;
+    # the median of every stage is reported in seconds.
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable,"-c",_STARTUP_SCRIPT.format(model_name=model_name)],capture_output=True,text=True,
+                                check=True,cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        timings.append(json.loads(output.strip().splitlines()[-1]))
+    results = {stage: float(np.median([timing[stage] for timing in timings])) for stage in timings[0]}
+    results["total"] = sum(results.values())
+    return results
+
+def print_results(results:dict):
+    names = list(next(iter(results.values())))
+    print("| Variant | "+" | ".join(names)+" |")
+    print("| --- "*(len(names)+1)+"|")
+    for variant, scores in results.items():
+        print(f"| {variant} | "+" | ".join(f"{scores[name]:.2f}" for name in names)+" |")
+
+if __name__ == "__main__":
+    import sys
+    model_name, repo_path = sys.argv[1], sys.argv[2]
+    print_results(compare_quantized(model_name,repo_path))
@@ -0,0 +1,182 @@
+import json,os
+import numpy as np
+from utils import lazy_import
+from embedding_cache import EmbeddingCache
+
+torch = lazy_import("torch")
+
+class HiddenStateStore:
+    # Append-only float16 store of the hidden states of every embedded token
+    # window. Only real (unpadded) tokens are written, so the attention mask is
+    # implied by each window's length. Windows are keyed by their token ids and
+    # shared between sources; each source records the windows it is made of.
+    def __init__(self,path:str,hidden_size:int=None,layers:int=1,max_bytes:int=10<<30):
+        os.makedirs(path,exist_ok=True)
+        self.path = path
+        meta_path = os.path.join(path,"meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as file:
+                meta = json.load(file)
+            self.hidden_size, self.layers = meta["hidden_size"], meta["layers"]
+        else:
+            if hidden_size is None:
+                raise ValueError("hidden_size is required to create a new hidden state store")
+            self.hidden_size, self.layers = hidden_size, layers
+            with open(meta_path,"w") as file:
+                json.dump({"hidden_size": hidden_size, "layers": layers},file)
+        self.max_bytes = max_bytes
+        self.skipped_windows = 0
+
+        self.windows = {}
+        # Windows left out once max_bytes was reached; they are recorded so that
+        # later runs do not recompute them only to skip them again.
+        self.skipped = set()
+        self.sources = {}
+        for key, record in self._read_index("windows.jsonl"):
+            if record.get("skipped"):
+                self.skipped.add(key)
+            else:
+                self.windows[key] = record
+        for key, record in self._read_index("sources.jsonl"):
+            self.sources[key] = record
+        self.total_tokens = sum(record["length"] for record in self.windows.values())
+        self._recover()
+
+        self._hidden_file = open(os.path.join(path,"hidden_states.f16"),"ab")
+        self._ids_file = open(os.path.join(path,"input_ids.i32"),"ab")
+        self._windows_file = open(os.path.join(path,"windows.jsonl"),"a")
+        self._sources_file = open(os.path.join(path,"sources.jsonl"),"a")
+        self._memmap = None
+
+    def _recover(self):
+        # A run killed between writing a window's data and its index line leaves
+        # orphan tokens at the end of the data files; new windows are appended
+        # after them while offsets follow total_tokens, so the files are cut
+        # back to the indexed tokens. Windows whose data never fully reached
+        # disk are dropped from the index instead.
+        files = {"hidden_states.f16": self.layers*self.hidden_size*2, "input_ids.i32": 4}
+        sizes = {name: os.path.getsize(os.path.join(self.path,name)) if os.path.exists(os.path.join(self.path,name)) else 0
+                 for name in files}
+        available = min(sizes[name]//token_bytes for name, token_bytes in files.items())
+        if available < self.total_tokens:
+            self.windows = {key: record for key, record in self.windows.items() if record["offset"]+record["length"] <= available}
+            self.total_tokens = sum(record["length"] for record in self.windows.values())
+            index_path = os.path.join(self.path,"windows.jsonl")
+            with open(index_path+".tmp","w") as file:
+                for key, record in self.windows.items():
+                    file.write(json.dumps({"key": key, **record})+"\n")
+                for key in self.skipped:
+                    file.write(json.dumps({"key": key, "skipped": True})+"\n")
+            os.replace(index_path+".tmp",index_path)
+        for name, token_bytes in files.items():
+            if sizes[name] > self.total_tokens*token_bytes:
+                os.truncate(os.path.join(self.path,name),self.total_tokens*token_bytes)
+
+    def _read_index(self,file_name:str):
+        index_path = os.path.join(self.path,file_name)
+        if not os.path.exists(index_path):
+            return
+        with open(index_path) as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record.pop("key"), record
+
+    @staticmethod
+    def window_key(window:bytes,model_name:str):
+        return EmbeddingCache.make_chunk_key(window,model_name,"hidden_states")
+
+    @staticmethod
+    def source_key(code:str,model_name:str,chunk_size:int,stride:int,chunking:str="window"):
+        return EmbeddingCache.make_key(code,model_name,chunk_size,stride,"hidden_states",chunking)
+
+    @property
+    def size_bytes(self):
+        return self.total_tokens*self.layers*self.hidden_size*2
+
+    def add_windows(self,keys:list,input_ids,attention_mask,hidden_states):
+        # hidden_states: [windows, tokens, layers, hidden_size]
+        lengths = attention_mask.sum(1).tolist()
+        token_bytes = self.layers*self.hidden_size*2
+        for key, ids, length, hidden in zip(keys,input_ids,lengths,hidden_states):
+            if self.covers(key):
+                continue
+            if self.size_bytes+length*token_bytes > self.max_bytes:
+                self.skipped_windows += 1
+                self.skipped.add(key)
+                self._windows_file.write(json.dumps({"key": key, "skipped": True})+"\n")
+                continue
+            self._hidden_file.write(hidden[:length].to("cpu",torch.float16).numpy().tobytes())
+            self._ids_file.write(ids[:length].to(torch.int32).numpy().tobytes())
+            self.windows[key] = {"offset": self.total_tokens, "length": length}
+            self._windows_file.write(json.dumps({"key": key, **self.windows[key]})+"\n")
+            self.total_tokens += length
+        self._hidden_file.flush()
+        self._ids_file.flush()
+        self._windows_file.flush()
+
+    def add_source(self,key:str,window_keys:list,window_starts:list,prefix_length:int,suffix_length:int):
+        # window_starts: position of each window's first content token in the file.
+        self.sources[key] = {"windows": window_keys, "starts": window_starts, "prefix_length": prefix_length, "suffix_length": suffix_length}
+        self._sources_file.write(json.dumps({"key": key, **self.sources[key]})+"\n")
+        self._sources_file.flush()
+
+    def covers(self,key:str):
+        # True for windows that are stored or were skipped for lack of space.
+        return key in self.windows or key in self.skipped
+
+    def has_source(self,key:str):
+        return key in self.sources and all(self.covers(window) for window in self.sources[key]["windows"])
+
+    def window_input_ids(self,key:str):
+        record = self.windows[key]
+        ids = np.memmap(os.path.join(self.path,"input_ids.i32"),dtype=np.int32,mode="r",shape=(self.total_tokens,))
+        return torch.from_numpy(np.array(ids[record["offset"]:record["offset"]+record["length"]],dtype=np.int64))
+
+    def window_hidden_states(self,key:str):
+        record = self.windows[key]
+        if self._memmap is None or len(self._memmap) < record["offset"]+record["length"]:
+            self._memmap = np.memmap(os.path.join(self.path,"hidden_states.f16"),dtype=np.float16,mode="r",
+                                     shape=(self.total_tokens,self.layers,self.hidden_size))
+        window = self._memmap[record["offset"]:record["offset"]+record["length"]]
+        return torch.from_numpy(np.asarray(window,dtype=np.float32))
+
+    def pool(self,source_key:str,pooling:str="last_hidden_state_mean",last_layers:int=None,token_span:tuple=None):
+        # Recomputes a file embedding without the model: each window is pooled and
+        # the file vector is the mean of its window vectors, as in EmbeddingGenerator.
+        # token_span=(start, end) restricts pooling to those content-token positions
+        # of the file; windows without tokens in the span are left out.
+        source = self.sources[source_key]
+        if any(window in self.skipped for window in source["windows"]):
+            raise ValueError(f"Hidden states of {source_key} were not stored: the store reached max_bytes")
+        vectors = []
+        for index, window_key in enumerate(source["windows"]):
+            hidden = self.window_hidden_states(window_key)
+            if pooling == "last_layers_mean":
+                if last_layers is None or last_layers > self.layers:
+                    raise ValueError(f"last_layers must be between 1 and the {self.layers} stored layers")
+                hidden = hidden[:,-last_layers:].mean(1)
+            else:
+                hidden = hidden[:,-1]
+            if token_span is not None:
+                # Special tokens belong to no file position and are left out of spans.
+                hidden = hidden[source["prefix_length"]:len(hidden)-source["suffix_length"]]
+                positions = source["starts"][index]+torch.arange(len(hidden))
+                hidden = hidden[(positions >= token_span[0]) & (positions < token_span[1])]
+                if not len(hidden):
+                    continue
+            if pooling in ("last_hidden_state_mean","last_layers_mean"):
+                vectors.append(hidden.mean(0))
+            elif pooling == "last_hidden_state_max":
+                vectors.append(hidden.max(0).values)
+            elif pooling == "cls" and token_span is None:
+                vectors.append(hidden[0])
+            else:
+                raise ValueError(f"Pooling {pooling!r} cannot be recomputed from stored hidden states")
+        if not vectors:
+            raise ValueError(f"No stored tokens fall inside span {token_span}")
+        return torch.stack(vectors).mean(0)
+
+    def close(self):
+        for file in (self._hidden_file,self._ids_file,self._windows_file,self._sources_file):
+            file.close()
@@ -0,0 +1,94 @@
+import os,tempfile,time
+import torch
+import onnxruntime as ort
+from transformers import AutoConfig
+from transformers.modeling_outputs import BaseModelOutput
+from embedding_generator import CACHE_DIR, load_model, local_model_path, model_cache_path
+
+DEFAULT_CACHE_DIR = os.path.join(CACHE_DIR,"onnx")
+OPSET = 17
+CAUSAL_MODEL_TYPES = ("gpt2",)
+
+class _LastHiddenState(torch.nn.Module):
+    def __init__(self,model):
+        super().__init__()
+        self.model = model
+        self.causal = model.config.model_type in CAUSAL_MODEL_TYPES
+
+    def forward(self,input_ids,attention_mask):
+        if self.causal:
+            # transformers builds the causal padding mask with vmap, which the ONNX
+            # tracer cannot follow; hand the model the additive 4D mask directly.
+            length = input_ids.shape[1]
+            causal = torch.ones(length,length,dtype=torch.bool,device=input_ids.device).tril()
+            allowed = causal[None,None] & attention_mask[:,None,None,:].bool()
+            attention_mask = torch.zeros(allowed.shape,device=input_ids.device).masked_fill(~allowed,torch.finfo(torch.float32).min)
+        return self.model(input_ids=input_ids,attention_mask=attention_mask).last_hidden_state
+
+def export_onnx(model_name:str,cache_dir:str=DEFAULT_CACHE_DIR):
+    path = model_cache_path(cache_dir,model_name,f"encoder_opset{OPSET}.onnx")
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+
+    # The SDPA mask helpers do not trace; eager attention exports to plain ONNX ops.
+    model = load_model(model_name,attn_implementation="eager").eval()
+    input_ids = torch.ones(2,16,dtype=torch.long)
+    attention_mask = torch.ones(2,16,dtype=torch.long)
+    # Export under a temporary name of this process, so an interrupted export is
+    # never picked up as cached and concurrent workers do not write the same file.
+    descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),prefix=".tmp-",suffix=".onnx")
+    os.close(descriptor)
+    try:
+        with torch.no_grad():
+            torch.onnx.export(_LastHiddenState(model),(input_ids,attention_mask),tmp_path,
+                              input_names=["input_ids","attention_mask"],output_names=["last_hidden_state"],
+                              dynamic_axes={"input_ids":{0:"batch",1:"sequence"},"attention_mask":{0:"batch",1:"sequence"},
+                                            "last_hidden_state":{0:"batch",1:"sequence"}},
+                              opset_version=OPSET,dynamo=False)
+        os.replace(tmp_path,path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+class OnnxEncoder:
+    # Drop-in stand-in for the transformers encoder used by EmbeddingGenerator:
+    # called with input_ids/attention_mask, returns an output with last_hidden_state.
+    def __init__(self,model_name:str,cache_dir:str=DEFAULT_CACHE_DIR,intra_op_threads:int=0):
+        self.config = AutoConfig.from_pretrained(local_model_path(model_name))
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(export_onnx(model_name,cache_dir),options,providers=["CPUExecutionProvider"])
+
+    def __call__(self,input_ids,attention_mask,**kwargs):
+        feeds = {"input_ids": input_ids.cpu().numpy(), "attention_mask": attention_mask.cpu().numpy()}
+        last_hidden_state = self.session.run(["last_hidden_state"],feeds)[0]
+        return BaseModelOutput(last_hidden_state=torch.from_numpy(last_hidden_state).to(input_ids.device))
+
+def compare_backends(model_name:str,codes:list,batch_size:int=32,tolerance:float=1e-4):
+    # Throughput of both backends plus a parity check: raises ValueError if any
+    # embedding component differs by more than `tolerance` (fp32 export noise is ~1e-6).
+    from embedding_generator import EmbeddingGenerator
+    results = {}
+    embeddings = {}
+    for backend in ("torch","onnx"):
+        generator = EmbeddingGenerator(model_name,batch_size=batch_size,backend=backend)
+        generator.generate_embeddings(codes[:batch_size])
+        start = time.perf_counter()
+        embeddings[backend] = generator.generate_embeddings(codes).cpu()
+        results[f"{backend}_files_per_second"] = len(codes)/(time.perf_counter()-start)
+    results["max_abs_diff"] = (embeddings["torch"]-embeddings["onnx"]).abs().max().item()
+    results["speedup"] = results["onnx_files_per_second"]/results["torch_files_per_second"]
+    if results["max_abs_diff"] > tolerance:
+        raise ValueError(f"ONNX embeddings of {model_name} differ from torch by {results['max_abs_diff']:.3g}, tolerance {tolerance:.3g}")
+    return results
+
+if __name__ == "__main__":
+    import sys
+    from utils import get_all_python_files, load_code_from_file
+    model_name, repo_path = sys.argv[1], sys.argv[2]
+    codes = [load_code_from_file(file) for file in get_all_python_files(repo_path)]
+    for name, value in compare_backends(model_name,codes).items():
+        print(f"{name}: {value}")
@@ -0,0 +1,107 @@
+import os,time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from embedding_generator import DTYPES, EmbeddingGenerator, default_device, load_model, resolve_dtype
+from utils import load_code_from_file
+
+_generator = None
+
+def _init_worker(model_name:str,threads:int,worker_counter,generator_kwargs:dict,model:torch.nn.Module=None):
+    global _generator
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+    # Pin each worker to its own block of cores so intra-op threads of different
+    # workers do not compete for the same cores.
+    if hasattr(os,"sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        start = (worker_index*threads) % len(cores)
+        os.sched_setaffinity(0,cores[start:start+threads] or cores)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    _generator = EmbeddingGenerator(model_name,model=model,**generator_kwargs)
+
+def load_shared_model(model_name:str,generator_kwargs:dict):
+    # Weights are moved to shared memory once in the parent; spawned workers
+    # receive handles to the same pages instead of loading private copies.
+    if generator_kwargs.get("backend","torch") != "torch" or generator_kwargs.get("quantize"):
+        raise ValueError("shared_weights requires the torch backend without quantization")
+    model = load_model(model_name).eval().requires_grad_(False)
+    # Cast before sharing: casting in a worker would give it a private copy of the weights.
+    dtype = resolve_dtype(generator_kwargs.get("dtype","fp32"),default_device())
+    return model.to(getattr(torch,DTYPES[dtype])).share_memory()
+
+def _pool(model_name:str,workers:int,threads:int,generator_kwargs:dict,model:torch.nn.Module=None):
+    context = mp.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers,mp_context=context,initializer=_init_worker,
+                               initargs=(model_name,threads,context.Value("i",0),generator_kwargs,model))
+
+def _embed_task(file_paths:list):
+    codes = [load_code_from_file(file_path) for file_path in file_paths]
+    embeddings = _generator.generate_embeddings(codes)
+    if isinstance(embeddings,dict):
+        return {name: pooled.cpu().numpy() for name, pooled in embeddings.items()}
+    return embeddings.cpu().numpy()
+
+def embed_files_parallel(file_paths:list,model_name:str,workers:int,threads:int,files_per_task:int=32,
+                         shared_weights:bool=False,**generator_kwargs):
+    # Workers pull file batches from the executor's shared queue as they become
+    # free; map() yields results in submission order, so the output order only
+    # depends on file_paths.
+    tasks = [file_paths[i:i+files_per_task] for i in range(0,len(file_paths),files_per_task)]
+    model = load_shared_model(model_name,generator_kwargs) if shared_weights else None
+    with _pool(model_name,workers,threads,generator_kwargs,model) as executor:
+        results = list(executor.map(_embed_task,tasks))
+    if results and isinstance(results[0],dict):
+        return {name: torch.from_numpy(np.concatenate([result[name] for result in results])) for name in results[0]}
+    return torch.from_numpy(np.concatenate(results)) if results else torch.empty(0)
+
+def candidate_splits(cpu_count:int=None):
+    if cpu_count is None:
+        cpu_count = len(os.sched_getaffinity(0)) if hasattr(os,"sched_getaffinity") else os.cpu_count()
+    return [(workers,cpu_count//workers) for workers in range(1,cpu_count+1) if cpu_count % workers == 0]
+
+def autotune(file_paths:list,model_name:str,splits:list=None,files_per_task:int=32,shared_weights:bool=False,
+             tasks_per_worker:int=4,**generator_kwargs):
+    # Times every workers x threads split that fills the host on a sample of
+    # files. Each split embeds the sample twice in the same pool and only the
+    # second pass is timed, so model loading does not skew the comparison.
+    # Tasks shrink below files_per_task where needed so that every worker gets
+    # at least tasks_per_worker of them and no split is timed with idle workers.
+    timings = {}
+    model = load_shared_model(model_name,generator_kwargs) if shared_weights else None
+    for workers, threads in splits or candidate_splits():
+        task_size = max(1,min(files_per_task,len(file_paths)//(workers*tasks_per_worker)))
+        tasks = [file_paths[i:i+task_size] for i in range(0,len(file_paths),task_size)]
+        with _pool(model_name,workers,threads,generator_kwargs,model) as executor:
+            list(executor.map(_embed_task,tasks))
+            start = time.perf_counter()
+            list(executor.map(_embed_task,tasks))
+            timings[(workers,threads)] = len(file_paths)/(time.perf_counter()-start)
+    best = max(timings,key=timings.get)
+    return best, timings
+
+if __name__ == "__main__":
+    import sys
+    import pandas as pd
+    from utils import get_all_python_files, get_folders
+    model_name, repo_path, output_csv = sys.argv[1], sys.argv[2], sys.argv[3]
+
+    patterns = [pattern for pattern in get_folders(repo_path) if pattern != "embeddings"]
+    labels, file_paths = [], []
+    for pattern in patterns:
+        python_files = get_all_python_files(os.path.join(repo_path,pattern))
+        labels.extend([pattern]*len(python_files))
+        file_paths.extend(python_files)
+
+    # At least 256 files, and enough for a few tasks of several files per core.
+    sample = file_paths[:max(256,16*(os.cpu_count() or 1))]
+    (workers, threads), timings = autotune(sample,model_name,shared_weights=True)
+    print(f"Using {workers} workers x {threads} threads ({timings[(workers,threads)]:.1f} files/s on sample)")
+    embeddings = embed_files_parallel(file_paths,model_name,workers,threads,shared_weights=True)
+
+    embeddings_df = pd.DataFrame(embeddings.numpy(),columns=[f'dim_{i}' for i in range(embeddings.shape[1])])
+    embeddings_df.insert(0,"pattern",labels)
+    embeddings_df.to_csv(output_csv,index=False)
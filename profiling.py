@@ -0,0 +1,70 @@
+import sys,time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import psutil
+from utils import lazy_import
+try:
+    import resource
+except ImportError:
+    resource = None
+
+torch = lazy_import("torch")
+
+STAGES = ("tokenize","chunk","to_device","forward","store","pool")
+
+def max_rss_bytes(process:psutil.Process):
+    # High-water mark of the process's resident memory, so memory allocated and
+    # freed inside a stage still counts. ru_maxrss is in KiB on Linux and in
+    # bytes on macOS; Windows reports its peak working set through psutil.
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss*1024
+    memory = process.memory_info()
+    return getattr(memory,"peak_wset",memory.rss)
+
+class StageProfiler:
+    # Opt-in instrumentation for EmbeddingGenerator(profiler=...). Each stage
+    # adds its wall time; when it ends, current resident memory is passed to
+    # callback(stage, seconds, rss_bytes) and the process's peak RSS is read.
+    # The peak covers the whole process lifetime, model loading included.
+    def __init__(self,callback=None):
+        self.callback = callback
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self.peak_rss = 0
+        self._process = psutil.Process()
+
+    @contextmanager
+    def stage(self,name:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            # CUDA kernels run asynchronously; wait for them so time lands in the right stage.
+            if torch.cuda.is_initialized():
+                torch.cuda.synchronize()
+            seconds = time.perf_counter()-start
+            rss = self._process.memory_info().rss
+            self.seconds[name] += seconds
+            self.calls[name] += 1
+            self.peak_rss = max(self.peak_rss,max_rss_bytes(self._process))
+            if self.callback is not None:
+                self.callback(name,seconds,rss)
+
+    def summary(self,stats:dict=None):
+        # stats: EmbeddingGenerator.stats, for the token and chunk counts.
+        stats = stats or {}
+        summary = {"stages": {name: {"seconds": self.seconds[name], "calls": self.calls[name]} for name in STAGES if self.calls[name]},
+                   "total_seconds": sum(self.seconds.values()), "peak_rss_bytes": self.peak_rss}
+        for name in ("chunks","chunks_embedded","real_tokens","padded_tokens"):
+            summary[name] = stats.get(name,0)
+        summary["padding_ratio"] = 1-summary["real_tokens"]/summary["padded_tokens"] if summary["padded_tokens"] else 0.0
+        return summary
+
+    def print_summary(self,stats:dict=None):
+        summary = self.summary(stats)
+        for name, stage in summary["stages"].items():
+            share = stage["seconds"]/summary["total_seconds"] if summary["total_seconds"] else 0.0
+            print(f"{name:>10}: {stage['seconds']:8.3f}s {share:6.1%} ({stage['calls']} calls)")
+        print(f"Chunks: {summary['chunks']} ({summary['chunks_embedded']} embedded), tokens: {summary['real_tokens']}, "
+              f"padding ratio: {summary['padding_ratio']:.2%}, peak RSS: {summary['peak_rss_bytes']/(1<<20):.0f} MiB")
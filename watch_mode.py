@@ -0,0 +1,196 @@
+import ctypes,errno,os,select,struct,time
+import joblib
+import pandas as pd
+from sklearn.svm import SVC
+from embedding_generator import EmbeddingGenerator
+from utils import SourceReader, _ignored, walk_directories, walk_files
+
+# inotify(7) event bits.
+IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x8, 0x40, 0x80
+IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x100, 0x200, 0x400, 0x4000, 0x8000, 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+def train_classifier(embeddings_csv:str,model_name:str,path:str):
+    # The SVC of Experiments/03_pattern_classiffier.ipynb, fitted on every row of
+    # an embeddings CSV and saved with the name of the model that embedded it.
+    data = pd.read_csv(embeddings_csv)
+    features = data.drop(columns=['pattern','sampled'],errors='ignore')
+    classifier = SVC(kernel='linear', random_state=42).fit(features.values,data['pattern'].values)
+    joblib.dump({"classifier": classifier, "model_name": model_name},path)
+
+def load_classifier(path:str):
+    saved = joblib.load(path)
+    return saved["classifier"], saved["model_name"]
+
+class _Inotify:
+    # Recursive watch over a directory tree through the Linux inotify syscalls.
+    # Only the directories walk_files enters are watched, so ignored trees do
+    # not use up the watch limit.
+    def __init__(self,root:str):
+        self._libc = ctypes.CDLL(None,use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(),"inotify_init1 failed")
+        self.root = root
+        self.directories = {}
+        # .gitignore rules in force for the entries of each watched directory.
+        self.rules = {}
+        try:
+            self.add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self,top:str):
+        for directory, rules in walk_directories(self.root,top):
+            wd = self._libc.inotify_add_watch(self.fd,os.fsencode(directory),WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                # The directory went away before it could be watched.
+                if error in (errno.ENOENT,errno.ENOTDIR):
+                    continue
+                raise OSError(error,f"inotify_add_watch failed for {directory}")
+            self.directories[wd] = directory
+            self.rules[directory] = rules
+
+    def watched(self,path:str):
+        # Whether walk_files would yield this file of a watched directory.
+        rules = self.rules.get(os.path.dirname(path))
+        return rules is not None and not (rules and _ignored(path,os.path.basename(path),False,rules))
+
+    def read(self,timeout:float):
+        # Yields (path, mask) for the events available within timeout seconds.
+        if not select.select([self.fd],[],[],timeout)[0]:
+            return
+        data = os.read(self.fd,1<<16)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data,offset)
+            name = data[offset+EVENT_HEADER.size:offset+EVENT_HEADER.size+length].rstrip(b"\0")
+            offset += EVENT_HEADER.size+length
+            if mask & IN_IGNORED:
+                self.rules.pop(self.directories.pop(wd,None),None)
+                continue
+            if wd in self.directories or mask & IN_Q_OVERFLOW:
+                yield os.path.join(self.directories.get(wd,""),os.fsdecode(name)), mask
+
+    def close(self):
+        os.close(self.fd)
+
+class PatternWatcher:
+    # Keeps pattern labels of the .py files under root up to date. Changes are
+    # picked up through inotify where available and by polling otherwise, then
+    # debounced: once no event has arrived for `debounce` seconds the changed
+    # files are embedded in one batch on the warm model and classified.
+    # on_update(path, label, seconds) receives every prediction, with label None
+    # for deleted files and seconds measured from the file's last modification
+    # (from when the deletion was noticed for deleted files).
+    def __init__(self,root:str,generator:EmbeddingGenerator,classifier,debounce:float=0.2,poll_interval:float=0.25,
+                 on_update=None,use_inotify:bool=True):
+        self.root = root
+        self.generator = generator
+        self.classifier = classifier
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.on_update = on_update or (lambda path, label, seconds: print(f"{path}: {label} ({seconds*1000:.0f} ms)"))
+        self.reader = SourceReader(workers=4)
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = _Inotify(root)
+            except (OSError,AttributeError):
+                self.inotify = None
+        self._snapshot = self._scan()
+        # One forward pass up front so the first real change does not pay for lazy initialisation.
+        generator.generate_embeddings(["def warm_up():\n    return None\n"])
+
+    def _scan(self):
+        snapshot = {}
+        for path in walk_files(self.root):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (stat.st_mtime_ns,stat.st_size)
+        return snapshot
+
+    def _poll(self):
+        snapshot = self._scan()
+        changed = {path for path, state in snapshot.items() if self._snapshot.get(path) != state}
+        changed |= set(self._snapshot)-set(snapshot)
+        self._snapshot = snapshot
+        return changed
+
+    def _events(self,timeout:float):
+        if self.inotify is None:
+            time.sleep(timeout)
+            return self._poll()
+        changed = set()
+        for path, mask in self.inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped; fall back to comparing against the last snapshot.
+                return self._poll()
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self.inotify.add_tree(path)
+                    except OSError:
+                        # Out of watches (ENOSPC) or similar: carry on by polling.
+                        # The snapshot dates from startup, so the first poll
+                        # also re-reports files inotify already delivered.
+                        self.inotify.close()
+                        self.inotify = None
+                        return changed | self._poll()
+                    changed.update(walk_files(self.root,top=path))
+            elif path.endswith(".py") and self.inotify.watched(path):
+                changed.add(path)
+        return changed
+
+    def classify(self,paths:list):
+        existing = [path for path in paths if os.path.isfile(path)]
+        predictions = {path: None for path in paths if path not in existing}
+        sources = list(self.reader.read(existing))
+        if sources:
+            embeddings = self.generator.generate_embeddings([code for _, code in sources])
+            for (path, _), label in zip(sources,self.classifier.predict(embeddings.cpu().numpy())):
+                predictions[path] = label
+        return predictions
+
+    @staticmethod
+    def _changed_at(path:str,noticed:float):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return noticed
+
+    def run(self,stop=None):
+        # Runs until stop (a threading.Event) is set, or forever. With polling a
+        # save is noticed within poll_interval, then classified after the
+        # debounce, which keeps the default end-to-end latency well under a second.
+        pending, last_event = {}, None
+        while stop is None or not stop.is_set():
+            timeout = self.debounce if pending else self.poll_interval if self.inotify is None else 1.0
+            changed = self._events(timeout)
+            now = time.time()
+            if changed:
+                for path in changed:
+                    pending.setdefault(path,now)
+                last_event = now
+            if pending and now-last_event >= self.debounce:
+                changed_at = {path: self._changed_at(path,noticed) for path, noticed in pending.items()}
+                for path, label in self.classify(sorted(pending)).items():
+                    self.on_update(path,label,time.time()-changed_at[path])
+                pending = {}
+        if self.inotify is not None:
+            self.inotify.close()
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1] == "train":
+        embeddings_csv, model_name, classifier_path = sys.argv[2], sys.argv[3], sys.argv[4]
+        train_classifier(embeddings_csv,model_name,classifier_path)
+    else:
+        root, classifier_path = sys.argv[2], sys.argv[3]
+        classifier, model_name = load_classifier(classifier_path)
+        PatternWatcher(root,EmbeddingGenerator(model_name),classifier).run()